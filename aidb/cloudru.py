@@ -1,12 +1,107 @@
+import concurrent.futures
+import hashlib
 import json
 import os
+import re
+import sqlite3
+import threading
 import time
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
+from urllib3.util.retry import Retry
 
-from .prompting import build_repair_messages
+from .prompting import build_batched_messages, build_messages, build_repair_messages
+
+try:
+    import orjson
+
+    def _json_loads(s: str) -> Any:
+        return orjson.loads(s)
+
+    def _json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # orjson опционален — fallback на stdlib
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+try:
+    import json_repair  # опционален: мягкий ремонт почти-валидного JSON
+except ImportError:
+    json_repair = None
+
+
+# Ёмкость LRU-кэша распарсенных результатов generate()
+_GEN_CACHE_MAX = 4096
+
+# Маркдаун-кодблок вокруг JSON-ответа модели: ```json ... ```
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.S | re.I)
+
+
+def _recover_json(s: str) -> Optional[Dict[str, Any]]:
+    """
+    Мягкое восстановление почти-валидного JSON: типичный случай — обрыв
+    по max_tokens или хвостовой мусор после закрывающей скобки. Сканируем
+    строку один раз, учитывая строковые литералы, и пытаемся распарсить
+    самый длинный сбалансированный (или досбалансированный закрывающими
+    скобками) префикс. Экономит целый repair-round-trip к модели.
+    """
+    start = s.find("{")
+    if start < 0:
+        return None
+    if json_repair is not None:
+        try:
+            obj = json_repair.loads(s[start:])
+            if isinstance(obj, dict):
+                return obj
+        except Exception:
+            pass
+
+    stack: List[str] = []
+    in_str = False
+    esc = False
+    # Кандидаты на точку среза: позиция конца значения + закрывающие скобки
+    candidates: List[Tuple[int, str]] = []
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+                candidates.append((i, "".join("}" if x == "{" else "]" for x in reversed(stack))))
+            continue
+        if c == '"':
+            in_str = True
+        elif c in "{[":
+            stack.append(c)
+            candidates.append((i, "".join("}" if x == "{" else "]" for x in reversed(stack))))
+        elif c in "}]":
+            if not stack:
+                break
+            stack.pop()
+            candidates.append((i, "".join("}" if x == "{" else "]" for x in reversed(stack))))
+            if not stack:
+                break
+        elif c.isdigit() or c in "el":  # конец числа / true|false|null
+            candidates.append((i, "".join("}" if x == "{" else "]" for x in reversed(stack))))
+
+    # Пробуем с конца: первый разбираемый префикс побеждает
+    for pos, closers in reversed(candidates[-50:]):
+        try:
+            obj = _json_loads(s[start : pos + 1] + closers)
+        except Exception:
+            continue
+        if isinstance(obj, dict):
+            return obj
+    return None
 
 
 class CloudRuBackend:
@@ -28,6 +123,8 @@ class CloudRuBackend:
         timeout: float = 60.0,
         retries: int = 2,
         backoff: float = 1.5,
+        hedge_delay: Optional[float] = None,
+        pool_size: int = 32,
     ) -> None:
         # Подгрузим .env (если указан) и по умолчанию из рабочей директории проекта
         if dotenv_path and os.path.exists(dotenv_path):
@@ -46,12 +143,55 @@ class CloudRuBackend:
         if not self.api_key:
             raise RuntimeError("Не задан CLOUDRU_API_KEY в окружении/.env")
 
+        # Эндпоинт вычисляем один раз: api_base может указывать как на /v1,
+        # так и на корень без /v1
+        if self.api_base.endswith("/v1"):
+            self._chat_url = f"{self.api_base}/chat/completions"
+        else:
+            self._chat_url = f"{self.api_base}/v1/chat/completions"
+
         self.primary_model = primary_model
         self.fallback_model = fallback_model
         self.timeout = timeout
         self.retries = retries
         self.backoff = backoff
+        # Задержка перед «хеджирующим» запросом к fallback-модели (по умолчанию половина таймаута)
+        self.hedge_delay = hedge_delay if hedge_delay is not None else timeout * 0.5
+        self.pool_size = int(pool_size)
         self.session = requests.Session()
+        # Ретраи переносим на уровень urllib3: повторяем только транзиентные
+        # статусы (429/5xx/408), уважаем Retry-After и используем экспоненциальный
+        # backoff с джиттером. Клиентские 4xx не ретраятся вовсе.
+        retry_kwargs: Dict[str, Any] = dict(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(408, 429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        try:
+            retry = Retry(backoff_jitter=0.5, **retry_kwargs)
+        except TypeError:
+            # urllib3 < 2 не знает backoff_jitter
+            retry = Retry(**retry_kwargs)
+        # Дефолтный HTTPAdapter держит всего 10 keep-alive соединений; под
+        # конкурентные запросы (хеджирование/батчинг) расширим пул, чтобы не
+        # платить TLS-рукопожатие на каждый запрос сверх лимита.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            pool_block=False,
+            max_retries=retry,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Заголовки неизменны — выставим на сессии один раз
+        self.session.headers.update(self._headers())
+        # LRU-кэш распарсенных результатов: (модели, messages, параметры) → dict
+        self._gen_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
 
     def _headers(self) -> Dict[str, str]:
         return {
@@ -59,26 +199,14 @@ class CloudRuBackend:
             "Content-Type": "application/json",
         }
 
-    def _chat_once(
+    def _build_body(
         self,
         model: str,
         messages: List[Dict[str, str]],
         gen_max_tokens: int,
         temperature: float,
         top_p: float,
-    ) -> Tuple[Optional[str], Optional[str]]:
-        """
-        Возврат: (text, error_message)
-        """
-        url = f"{self.api_base}/chat/completions" if not self.api_base.endswith("/v1") else f"{self.api_base}/chat/completions"
-        # Если api_base уже оканчивается на /v1 — оставим как есть.
-        # Дополнительно поддержим случай, когда api_base указывает на корень без /v1.
-        if self.api_base.endswith("/v1"):
-            url = f"{self.api_base}/chat/completions"
-        else:
-            # Попробуем добавить /v1
-            url = f"{self.api_base}/v1/chat/completions"
-
+    ) -> bytes:
         payload = {
             "model": model,
             "messages": messages,
@@ -88,19 +216,50 @@ class CloudRuBackend:
             # Запросим строгий JSON-объект на стороне модели, если поддерживается
             "response_format": {"type": "json_object"},
         }
+        return _json_dumps(payload)
+
+    def _chat_once(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+        body: Optional[bytes] = None,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Возврат: (text, error_message)
+
+        body — заранее сериализованный payload (см. _chat_with_retries): при
+        повторных попытках messages не сериализуются заново.
+        """
+        url = self._chat_url
+
+        if body is None:
+            body = self._build_body(model, messages, gen_max_tokens, temperature, top_p)
 
         try:
-            resp = self.session.post(url, headers=self._headers(), json=payload, timeout=self.timeout)
+            resp = self.session.post(url, data=body, timeout=self.timeout, stream=True)
         except Exception as e:
             return None, f"request_error: {e!r}"
 
         if resp.status_code != 200:
             return None, f"http_{resp.status_code}: {resp.text[:500]}"
 
+        # Читаем тело чанками по мере прихода, не дожидаясь полного ответа,
+        # чтобы совместить сетевое ожидание с накоплением буфера
+        buf = bytearray()
+        try:
+            for chunk in resp.iter_content(chunk_size=65536):
+                if chunk:
+                    buf.extend(chunk)
+        except Exception as e:
+            return None, f"request_error: {e!r}"
+
         try:
-            data = resp.json()
+            data = _json_loads(bytes(buf))
         except Exception as e:
-            return None, f"bad_json: {e!r} body={resp.text[:500]}"
+            return None, f"bad_json: {e!r} body={bytes(buf)[:500]!r}"
 
         # Попробуем извлечь OpenAI-компатибельный контент
         try:
@@ -123,11 +282,20 @@ class CloudRuBackend:
         temperature: float,
         top_p: float,
     ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Транспортные ретраи (429/5xx, обрывы соединения) выполняет urllib3.Retry
+        на адаптере сессии. Здесь повторяем только ошибки разбора ответа
+        (bad_json / no_text_in_response) — тело пришло, но оказалось битым.
+        """
+        # Сериализуем payload один раз на все попытки
+        body = self._build_body(model, messages, gen_max_tokens, temperature, top_p)
         delay = 0.5
         for attempt in range(1, self.retries + 1):
-            text, err = self._chat_once(model, messages, gen_max_tokens, temperature, top_p)
+            text, err = self._chat_once(model, messages, gen_max_tokens, temperature, top_p, body=body)
             if err is None and text is not None:
                 return text, None
+            if not (err or "").startswith(("bad_json", "no_text_in_response")):
+                break
             if attempt < self.retries:
                 time.sleep(delay)
                 delay *= self.backoff
@@ -137,20 +305,37 @@ class CloudRuBackend:
         s = (s or "").strip()
         if not s:
             return None
+        # Быстрый отсев: валидный ответ начинается либо с '{', либо с кодблока
+        if not (s.startswith("{") or s.startswith("```")):
+            return None
         # На случай, если модель обернёт в кодблоки
-        if s.startswith("```"):
-            s = s.strip("`").strip()
-            # Уберём возможный префикс типа json
-            if s.lower().startswith("json"):
-                s = s[4:].strip()
+        m = _FENCE_RE.match(s)
+        if m:
+            s = m.group(1)
         try:
-            obj = json.loads(s)
+            obj = _json_loads(s)
             if isinstance(obj, dict):
                 return obj
         except Exception:
-            return None
+            # Попытка восстановить усечённый/замусоренный JSON без повторного
+            # обращения к модели
+            return _recover_json(s)
         return None
 
+    def _cache_key(
+        self,
+        messages: List[Dict[str, str]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+    ) -> bytes:
+        basis = json.dumps(
+            [self.primary_model, self.fallback_model, messages,
+             int(gen_max_tokens), float(temperature), float(top_p)],
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.blake2b(basis.encode("utf-8"), digest_size=16).digest()
+
     def generate(
         self,
         sources: List[Dict[str, Any]],
@@ -158,63 +343,441 @@ class CloudRuBackend:
         gen_max_tokens: int,
         temperature: float,
         top_p: float,
+        use_cache: bool = True,
     ) -> Dict[str, Any]:
         """
         Основной вызов: отправляем messages, парсим JSON. При неудаче —
         пытаемся сделать «ремонт» через build_repair_messages(bad_output).
-        Также предусмотрен fallback-модель.
+
+        Primary и fallback выполняются конкурентно («хеджирование»): fallback
+        стартует через hedge_delay секунд, если primary ещё не ответил (или
+        сразу, если primary вернул пустой список фактов / невалидный вывод).
+        Побеждает первый валидный JSON с непустым списком facts; проигравшие
+        запросы отменяются или дорабатывают в фоне.
+
+        Распарсенные результаты кэшируются по хэшу (модели, messages, параметры):
+        повторный вызов с тем же входом (дубликат сообщения, повтор батча)
+        не ходит в сеть вовсе.
         """
-        # 1) primary
+        key: Optional[bytes] = None
+        if use_cache:
+            key = self._cache_key(messages, gen_max_tokens, temperature, top_p)
+            cached = self._gen_cache.get(key)
+            if cached is not None:
+                self._gen_cache.move_to_end(key)
+                return cached
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        try:
+            result = self._generate_hedged(
+                executor, messages, gen_max_tokens, temperature, top_p
+            )
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Кэшируем только непустые результаты: пустой список фактов может
+        # означать транзиентный сбой, который не стоит «запоминать».
+        if key is not None and result.get("facts"):
+            self._gen_cache[key] = result
+            if len(self._gen_cache) > _GEN_CACHE_MAX:
+                self._gen_cache.popitem(last=False)
+        return result
+
+    def _generate_hedged(
+        self,
+        executor: concurrent.futures.Executor,
+        messages: List[Dict[str, str]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+    ) -> Dict[str, Any]:
+        # Метаданные по future: какая модель ответила (для цепочки ремонта)
+        model_of: Dict[concurrent.futures.Future, str] = {}
+        repaired: set = set()  # модели, для которых ремонт уже запускался
+
+        def submit_chat(model: str, msgs: List[Dict[str, str]], temp: float) -> None:
+            fut = executor.submit(
+                self._chat_with_retries, model, msgs, gen_max_tokens, temp, top_p
+            )
+            model_of[fut] = model
+            pending.add(fut)
+
+        pending: set = set()
+        submit_chat(self.primary_model, messages, temperature)
+        hedged = self.fallback_model is None  # без fallback хеджировать нечего
+
+        def start_hedge() -> None:
+            nonlocal hedged
+            if not hedged and self.fallback_model:
+                submit_chat(self.fallback_model, messages, temperature)
+                hedged = True
+
+        empty_result: Optional[Dict[str, Any]] = None
+
+        while pending:
+            wait_timeout = self.hedge_delay if not hedged else None
+            done, pending = concurrent.futures.wait(
+                pending, timeout=wait_timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if not done:
+                # Primary молчит дольше hedge_delay — запускаем fallback параллельно
+                start_hedge()
+                continue
+
+            for fut in done:
+                model = model_of.get(fut, self.primary_model)
+                try:
+                    text, err = fut.result()
+                except Exception:
+                    text, err = None, "future_error"
+                parsed = self._parse_json(text or "")
+                if parsed is not None and isinstance(parsed.get("facts"), list):
+                    if parsed.get("facts"):
+                        # Победитель: отменим проигравших (остальные дорабатывают в фоне)
+                        for f in pending:
+                            f.cancel()
+                        return parsed
+                    # Валидный, но пустой результат — запомним и дадим шанс fallback
+                    empty_result = parsed
+                    start_hedge()
+                    continue
+                if text and model not in repaired:
+                    # Невалидный вывод — цепочка ремонта на той же модели
+                    repaired.add(model)
+                    submit_chat(model, build_repair_messages(text), max(0.0, temperature - 0.1))
+                    continue
+                # Модель не ответила вовсе — даём шанс fallback, если не запущен
+                start_hedge()
+
+        # Если непустых фактов не получили — вернём пустую структуру
+        return empty_result if empty_result is not None else {"facts": []}
+
+    def generate_many(
+        self,
+        calls: List[Dict[str, Any]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+        concurrency: int = 32,
+        use_cache: bool = True,
+    ) -> List[Dict[str, Any]]:
+        """
+        Конкурентный запуск независимых generate()-вызовов: LLM API ограничен
+        латентностью, поэтому масштабируемся числом одновременных запросов,
+        а не скоростью одного. calls — список элементов вида
+        {"sources": [...], "messages": [...]}; результат — список той же длины
+        в исходном порядке. Сессия одна на всех: пул соединений (pool_size)
+        рассчитан на конкурентную работу.
+        """
+        if not calls:
+            return []
+        results: List[Dict[str, Any]] = [{"facts": []} for _ in calls]
+        workers = max(1, min(int(concurrency), len(calls)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            future_to_idx = {
+                executor.submit(
+                    self.generate,
+                    call.get("sources") or [],
+                    call["messages"],
+                    gen_max_tokens,
+                    temperature,
+                    top_p,
+                    use_cache,
+                ): idx
+                for idx, call in enumerate(calls)
+            }
+            for fut in concurrent.futures.as_completed(future_to_idx):
+                idx = future_to_idx[fut]
+                try:
+                    results[idx] = fut.result()
+                except Exception:
+                    results[idx] = {"facts": []}
+        return results
+
+    def generate_batch(
+        self,
+        items: List[Dict[str, Any]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+        batch_size: int = 16,
+        hints: str = "",
+    ) -> List[Dict[str, Any]]:
+        """
+        Пакетная обработка: упаковывает по batch_size источников в один промпт
+        (нумерованные строки [[N]], см. build_batched_messages) и демультиплексирует
+        ответ {"results": [{"row": N, "facts": [...]}]} обратно по элементам.
+
+        Возвращает список той же длины, что items: по {"facts": [...]} на элемент.
+        Если пакет не удаётся распарсить — он бисекцией делится пополам и половины
+        отправляются заново (вместо повтора всего пакета целиком).
+        """
+        results: List[Dict[str, Any]] = [{"facts": []} for _ in items]
+        for start in range(0, len(items), max(1, int(batch_size))):
+            group = items[start : start + max(1, int(batch_size))]
+            self._generate_rows(group, start, results, gen_max_tokens, temperature, top_p, hints)
+        return results
+
+    def _generate_rows(
+        self,
+        group: List[Dict[str, Any]],
+        offset: int,
+        results: List[Dict[str, Any]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+        hints: str,
+    ) -> None:
+        if not group:
+            return
+        if len(group) == 1:
+            # Одиночный элемент — обычный путь generate с ремонтом/фоллбэком
+            messages = build_messages(
+                [{"source_id": group[0].get("source_id", ""), "text": group[0].get("text", "")}],
+                hints=hints,
+            )
+            results[offset] = self.generate(group, messages, gen_max_tokens, temperature, top_p)
+            return
+
+        messages = build_batched_messages(group, hints=hints)
         text, err = self._chat_with_retries(
             self.primary_model, messages, gen_max_tokens, temperature, top_p
         )
-        parsed = self._parse_json(text or "")
-        if parsed is not None and isinstance(parsed.get("facts"), list):
-            # Если primary вернул корректный JSON, но без фактов — попробуем fallback-модель
-            if self.fallback_model and not parsed.get("facts"):
-                text_fb, err_fb = self._chat_with_retries(
-                    self.fallback_model, messages, gen_max_tokens, temperature, top_p
-                )
-                parsed_fb = self._parse_json(text_fb or "")
-                if parsed_fb is not None and isinstance(parsed_fb.get("facts"), list) and parsed_fb.get("facts"):
-                    return parsed_fb
-            return parsed
-
-        # 2) repair на primary
-        if text:
-            repair_msgs = build_repair_messages(text)
+        rows = self._parse_rows(text, len(group))
+        if rows is None and text:
+            # Одна попытка ремонта, затем бисекция
             text2, err2 = self._chat_with_retries(
-                self.primary_model, repair_msgs, gen_max_tokens, max(0.0, temperature - 0.1), top_p
-            )
-            parsed2 = self._parse_json(text2 or "")
-            if parsed2 is not None and isinstance(parsed2.get("facts"), list):
-                if self.fallback_model and not parsed2.get("facts"):
-                    text_fb2, err_fb2 = self._chat_with_retries(
-                        self.fallback_model, messages, gen_max_tokens, temperature, top_p
-                    )
-                    parsed_fb2 = self._parse_json(text_fb2 or "")
-                    if parsed_fb2 is not None and isinstance(parsed_fb2.get("facts"), list) and parsed_fb2.get("facts"):
-                        return parsed_fb2
-                return parsed2
-
-        # 3) fallback (если задан)
-        if self.fallback_model:
-            text3, err3 = self._chat_with_retries(
-                self.fallback_model, messages, gen_max_tokens, temperature, top_p
+                self.primary_model, build_repair_messages(text), gen_max_tokens,
+                max(0.0, temperature - 0.1), top_p,
             )
-            parsed3 = self._parse_json(text3 or "")
-            if parsed3 is not None and isinstance(parsed3.get("facts"), list):
-                return parsed3
-
-            # 4) repair на fallback
-            if text3:
-                repair_msgs2 = build_repair_messages(text3)
-                text4, err4 = self._chat_with_retries(
-                    self.fallback_model, repair_msgs2, gen_max_tokens, max(0.0, temperature - 0.1), top_p
+            rows = self._parse_rows(text2, len(group))
+        if rows is None:
+            # Бисекция: повторим половинами вместо всего пакета
+            mid = len(group) // 2
+            self._generate_rows(group[:mid], offset, results, gen_max_tokens, temperature, top_p, hints)
+            self._generate_rows(group[mid:], offset + mid, results, gen_max_tokens, temperature, top_p, hints)
+            return
+        for row_idx, facts in rows.items():
+            results[offset + row_idx - 1] = {"facts": facts}
+
+    def batch_api_url(self, path: str) -> str:
+        base = self.api_base if self.api_base.endswith("/v1") else f"{self.api_base}/v1"
+        return f"{base}{path}"
+
+    def _parse_rows(self, text: Optional[str], n_rows: int) -> Optional[Dict[int, List[Any]]]:
+        """
+        Разбор пакетного ответа. Возврат: {row: facts} либо None при невалидном JSON.
+        Строки с некорректными row/facts пропускаются (для них останется пустой результат).
+        """
+        parsed = self._parse_json(text or "")
+        if parsed is None or not isinstance(parsed.get("results"), list):
+            return None
+        rows: Dict[int, List[Any]] = {}
+        for entry in parsed["results"]:
+            if not isinstance(entry, dict):
+                continue
+            row = entry.get("row")
+            facts = entry.get("facts")
+            if not isinstance(row, int) or not (1 <= row <= n_rows):
+                continue
+            if not isinstance(facts, list):
+                continue
+            rows[row] = facts
+        return rows
+
+
+class BatchBackend:
+    """
+    Обёртка над CloudRuBackend для провайдерского Batch API (OpenAI-совместимые
+    /v1/files + /v1/batches). Тысячи независимых промптов без зависимости по
+    порядку — классический кейс: дешевле и с куда большей пропускной
+    способностью, чем онлайновые запросы по одному батчу.
+
+    Протокол:
+      submit_batch(prompts)  -> batch_id   (prompts: [{"custom_id", "messages"}])
+      poll(batch_id)         -> строка-статус провайдера
+      fetch_results(batch_id)-> {custom_id: распарсенный dict с "facts"}
+    """
+
+    # Статусы, после которых опрос прекращается
+    TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+    def __init__(self, backend: CloudRuBackend, poll_interval: float = 30.0) -> None:
+        self.backend = backend
+        self.session = backend.session
+        self.poll_interval = poll_interval
+
+    def submit_batch(
+        self,
+        prompts: List[Dict[str, Any]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+    ) -> str:
+        lines: List[bytes] = []
+        for p in prompts:
+            body = {
+                "model": self.backend.primary_model,
+                "messages": p["messages"],
+                "temperature": float(temperature),
+                "top_p": float(top_p),
+                "max_tokens": int(gen_max_tokens),
+                "response_format": {"type": "json_object"},
+            }
+            lines.append(_json_dumps({
+                "custom_id": str(p["custom_id"]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }))
+        payload = b"\n".join(lines) + b"\n"
+
+        # Заливка JSONL-файла (multipart: снимаем Content-Type сессии)
+        resp = self.session.post(
+            self.backend.batch_api_url("/files"),
+            files={"file": ("batch_input.jsonl", payload, "application/jsonl")},
+            data={"purpose": "batch"},
+            headers={"Content-Type": None},
+            timeout=self.backend.timeout,
+        )
+        resp.raise_for_status()
+        file_id = resp.json()["id"]
+
+        resp = self.session.post(
+            self.backend.batch_api_url("/batches"),
+            json={
+                "input_file_id": file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            },
+            timeout=self.backend.timeout,
+        )
+        resp.raise_for_status()
+        return resp.json()["id"]
+
+    def poll(self, batch_id: str) -> str:
+        resp = self.session.get(
+            self.backend.batch_api_url(f"/batches/{batch_id}"), timeout=self.backend.timeout
+        )
+        resp.raise_for_status()
+        return str(resp.json().get("status", "unknown"))
+
+    def wait(self, batch_id: str) -> str:
+        """Блокирующий опрос до терминального статуса."""
+        while True:
+            status = self.poll(batch_id)
+            if status in self.TERMINAL_STATUSES:
+                return status
+            time.sleep(self.poll_interval)
+
+    def fetch_results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        resp = self.session.get(
+            self.backend.batch_api_url(f"/batches/{batch_id}"), timeout=self.backend.timeout
+        )
+        resp.raise_for_status()
+        output_file_id = resp.json().get("output_file_id")
+        if not output_file_id:
+            return {}
+        resp = self.session.get(
+            self.backend.batch_api_url(f"/files/{output_file_id}/content"),
+            timeout=self.backend.timeout,
+        )
+        resp.raise_for_status()
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for line in resp.content.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = _json_loads(line)
+            except Exception:
+                continue
+            cid = entry.get("custom_id")
+            if not cid:
+                continue
+            try:
+                text = entry["response"]["body"]["choices"][0]["message"]["content"]
+            except Exception:
+                continue
+            parsed = self.backend._parse_json(str(text))
+            if parsed is not None and isinstance(parsed.get("facts"), list):
+                results[str(cid)] = parsed
+        return results
+
+
+class CachedBackend:
+    """
+    Обёртка над бэкендом с персистентным exact-match кэшем prompt → output
+    в SQLite. В отличие от внутрипроцессного LRU в CloudRuBackend, кэш
+    переживает перезапуски: повторный прогон по тому же корпусу (или чат,
+    где одни и те же «ок»/«спасибо» повторяются из батча в батч) не ходит
+    в сеть вовсе. Ключ — blake2b от (messages, параметры генерации), то
+    есть совпадение строго по промпту; семантический поиск по эмбеддингам
+    сознательно не делаем — тянет тяжёлые зависимости, а на телеграм-чатах
+    основной выигрыш даёт именно точное совпадение коротких сообщений.
+    """
+
+    def __init__(self, backend: CloudRuBackend, cache_path: str) -> None:
+        self.backend = backend
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS gen_cache (key TEXT PRIMARY KEY, output TEXT NOT NULL)"
+        )
+        for pragma in ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL"):
+            try:
+                self._conn.execute(pragma)
+            except sqlite3.Error:
+                pass
+        self._conn.commit()
+        # generate() зовётся из пула потоков билдера — доступ к одному
+        # соединению сериализуем
+        self._lock = threading.Lock()
+
+    def _key(self, messages: List[Dict[str, str]], gen_max_tokens: int, temperature: float, top_p: float) -> str:
+        basis = _json_dumps(
+            {"messages": messages, "max_tokens": gen_max_tokens, "temperature": temperature, "top_p": top_p}
+        )
+        return hashlib.blake2b(basis, digest_size=16).hexdigest()
+
+    def generate(
+        self,
+        sources: List[Dict[str, Any]],
+        messages: List[Dict[str, str]],
+        gen_max_tokens: int,
+        temperature: float,
+        top_p: float,
+    ) -> Dict[str, Any]:
+        key = self._key(messages, gen_max_tokens, temperature, top_p)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output FROM gen_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            try:
+                cached = _json_loads(row[0])
+                if isinstance(cached, dict):
+                    return cached
+            except Exception:
+                pass  # битую запись молча перезапишем свежим результатом
+
+        out = self.backend.generate(
+            sources=sources,
+            messages=messages,
+            gen_max_tokens=gen_max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+        )
+        # Кэшируем только осмысленный результат: пустой facts может быть
+        # следствием сбоя, а не свойством промпта
+        if isinstance(out, dict) and out.get("facts"):
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO gen_cache (key, output) VALUES (?, ?)",
+                    (key, _json_dumps(out).decode("utf-8")),
                 )
-                parsed4 = self._parse_json(text4 or "")
-                if parsed4 is not None and isinstance(parsed4.get("facts"), list):
-                    return parsed4
+                self._conn.commit()
+        return out
 
-        # Если не удалось — вернём пустую структуру
-        return {"facts": []}
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,5 +1,335 @@
+import os
+import queue
 import sqlite3
-from typing import Dict, Generator, Iterable, Optional
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
+
+# Кэш схемы (список колонок) по (db_path, table): PRAGMA table_info выполняется
+# один раз, а не при каждом вызове iter_messages/count_messages
+_SCHEMA_CACHE: Dict[Tuple[str, str], List[str]] = {}
+
+# Пул read-only соединений по db_path: при множестве мелких вызовов из
+# worker-потоков экономит настройку соединения и повторные PRAGMA
+_POOL: Dict[str, "queue.LifoQueue[sqlite3.Connection]"] = {}
+_POOL_LOCK = threading.Lock()
+_POOL_MAX = 8  # хранимых соединений на базу
+
+
+def _pool_for(db_path: str) -> "queue.LifoQueue[sqlite3.Connection]":
+    key = os.path.abspath(db_path)
+    with _POOL_LOCK:
+        q = _POOL.get(key)
+        if q is None:
+            q = _POOL[key] = queue.LifoQueue(maxsize=_POOL_MAX)
+        return q
+
+
+def _acquire_conn(db_path: str) -> sqlite3.Connection:
+    try:
+        return _pool_for(db_path).get_nowait()
+    except queue.Empty:
+        return _connect_ro(db_path)
+
+
+def _release_conn(db_path: str, conn: sqlite3.Connection) -> None:
+    try:
+        _pool_for(db_path).put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def _pooled(db_path: str) -> Iterator[sqlite3.Connection]:
+    """with _pooled(db_path) as conn: — соединение из пула с возвратом."""
+    conn = _acquire_conn(db_path)
+    try:
+        yield conn
+    finally:
+        _release_conn(db_path, conn)
+
+
+def _connect_ro(db_path: str) -> sqlite3.Connection:
+    """
+    Read-only соединение, настроенное под сканирование больших таблиц:
+    WAL + mmap + увеличенный page-кэш превращают последовательное чтение
+    в чтение из OS page cache. Модуль ничего не пишет, поэтому query_only.
+    """
+    # check_same_thread=False: соединение может вернуться в пул из одного
+    # потока и быть выданным другому (одновременно им пользуется один поток)
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    except sqlite3.OperationalError:
+        # Например, файл ещё не существует — отдадим обычное соединение,
+        # чтобы ошибка всплыла в привычном месте
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-65536",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA query_only=1",
+    ):
+        try:
+            conn.execute(pragma)
+        except sqlite3.Error:
+            # Часть PRAGMA недоступна на read-only базе — не критично
+            pass
+    return conn
+
+
+def _table_columns(cur: sqlite3.Cursor, db_path: str, table: str) -> List[str]:
+    key = (os.path.abspath(db_path), table)
+    cols = _SCHEMA_CACHE.get(key)
+    if cols is None:
+        cur.execute(f"PRAGMA table_info({table})")
+        cols = [r[1] for r in cur.fetchall()]
+        _SCHEMA_CACHE[key] = cols
+    return cols
+
+
+def _pick_text_col(cols: List[str]) -> Optional[str]:
+    # Универсальный выбор текстовой колонки: text | message | content | body
+    for cand in ("text", "message", "content", "body"):
+        if cand in cols:
+            return cand
+    return None
+
+
+def ensure_indexes(db_path: str, table: str = "messages") -> bool:
+    """
+    Однократно создаёт индексы, ускоряющие фильтры iter_messages:
+      - индекс по выражению (id, length(text_col)) — фильтр min_text_len
+        перестаёт требовать полного скана;
+      - составной (topic_id, id) — фильтр по топику идёт по индексу.
+    База может быть открыта read-only или лежать на RO-носителе —
+    в этом случае тихо возвращаем False.
+    """
+    try:
+        conn = sqlite3.connect(db_path)
+    except sqlite3.Error:
+        return False
+    try:
+        cur = conn.cursor()
+        cols = _table_columns(cur, db_path, table)
+        text_col = _pick_text_col(cols)
+        if text_col:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table}_id_len ON {table}(id, length({text_col}))"
+            )
+        if "topic_id" in cols:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table}_topic_id ON {table}(topic_id, id)"
+            )
+        conn.commit()
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+
+class MessagesReader:
+    """
+    Читатель таблицы сообщений с одним долгоживущим соединением.
+
+    Схема (набор колонок, текстовое поле, опциональные поля) детектируется
+    один раз при создании; повторные iter()/count() не платят ни за открытие
+    соединения, ни за PRAGMA table_info. Поддерживает контекстный менеджер:
+
+        with MessagesReader(db_path) as reader:
+            total = reader.count()
+            for item in reader.iter():
+                ...
+    """
+
+    def __init__(self, db_path: str, table: str = "messages") -> None:
+        self.db_path = db_path
+        self.table = table
+        # Соединение берём из пула (возвращается в close())
+        self.conn: Optional[sqlite3.Connection] = _acquire_conn(db_path)
+        try:
+            cur = self.conn.cursor()
+            self.cols = _table_columns(cur, db_path, table)
+            if "id" not in self.cols:
+                raise RuntimeError(f"Таблица {table} должна содержать колонку id. Найдены: {self.cols}")
+            text_col = _pick_text_col(self.cols)
+            if not text_col:
+                raise RuntimeError(
+                    f"Таблица {table} должна содержать одну из текстовых колонок (text|message|content|body). Найдены: {self.cols}"
+                )
+        except Exception:
+            self.close()
+            raise
+        self.text_col = text_col
+        # Дополнительно детектируем служебные поля если присутствуют
+        self.date_col = "date" if "date" in self.cols else None
+        self.topic_id_col = "topic_id" if "topic_id" in self.cols else None
+        self.topic_title_col = "topic_title" if "topic_title" in self.cols else None
+
+    def __enter__(self) -> "MessagesReader":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.conn is not None:
+            _release_conn(self.db_path, self.conn)
+            self.conn = None
+
+    def _where(
+        self,
+        start_after_id: int,
+        filter_topic_id: Optional[int],
+        filter_topic_title_contains: Optional[str],
+        min_text_len: Optional[int],
+    ) -> Tuple[List[str], List[Any]]:
+        where = ["id > ?"]
+        params: List[Any] = [start_after_id]
+        if min_text_len is not None:
+            where.append(f"length({self.text_col}) >= ?")
+            params.append(int(min_text_len))
+        if filter_topic_id is not None and self.topic_id_col:
+            where.append(f"{self.topic_id_col} = ?")
+            params.append(int(filter_topic_id))
+        if filter_topic_title_contains and self.topic_title_col:
+            where.append(f"{self.topic_title_col} LIKE ?")
+            params.append(f"%{filter_topic_title_contains}%")
+        return where, params
+
+    def iter(
+        self,
+        start_after_id: int = 0,
+        limit_rows: Optional[int] = None,
+        filter_topic_id: Optional[int] = None,
+        filter_topic_title_contains: Optional[str] = None,
+        min_text_len: Optional[int] = None,
+        with_total: bool = False,
+    ) -> Generator[Dict, None, None]:
+        """
+        Итератор элементов {"id", "text", "source_id", ...опциональные поля}.
+        При with_total=True первым значением генератор отдаёт int — количество
+        строк результата (оконный COUNT(*) OVER (), до применения LIMIT).
+        """
+        # Сформируем SELECT с фиксированным порядком колонок: id, text, source_id
+        # (конкатенацию 'msg:' || id делает сам SQLite), затем опциональные поля
+        # (их имена запоминаем для позиционного доступа)
+        select_cols = [f"id", f"{self.text_col} AS text", "('msg:' || id) AS source_id"]
+        opt_fields = []
+        if self.date_col:
+            select_cols.append(f"{self.date_col} AS date")
+            opt_fields.append("date")
+        if self.topic_id_col:
+            select_cols.append(f"{self.topic_id_col} AS topic_id")
+            opt_fields.append("topic_id")
+        if self.topic_title_col:
+            select_cols.append(f"{self.topic_title_col} AS topic_title")
+            opt_fields.append("topic_title")
+        if with_total:
+            # Оконный COUNT по всему результату (до LIMIT) — последней колонкой,
+            # чтобы позиции опциональных полей не сдвигались
+            select_cols.append("COUNT(*) OVER () AS _total")
+
+        # Порядок обхода от старых к новым: ORDER BY id ASC
+        where, params = self._where(
+            start_after_id, filter_topic_id, filter_topic_title_contains, min_text_len
+        )
+        sql = f"SELECT {', '.join(select_cols)} FROM {self.table} WHERE " + " AND ".join(where) + " ORDER BY id ASC"
+        if limit_rows is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit_rows))
+
+        # Забираем строки пачками: один переход C→Python на ~1000 строк
+        # вместо перехода на каждую строку
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        cur.arraysize = 1024
+        first_batch = True
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+                if with_total and first_batch:
+                    yield 0
+                break
+            if with_total and first_batch:
+                yield int(rows[0][-1] or 0)
+            first_batch = False
+            for row in rows:
+                rid = row[0]
+                text = row[1]
+                item = {
+                    "id": rid,
+                    "text": text if type(text) is str else ("" if text is None else str(text)),
+                    "source_id": row[2],
+                }
+                # Опциональные поля — по позиции, коэрция типов только при необходимости
+                for pos, name in enumerate(opt_fields, start=3):
+                    v = row[pos]
+                    if v is None:
+                        continue
+                    if name == "topic_id":
+                        item[name] = v if type(v) is int else int(v)
+                    else:
+                        item[name] = v if type(v) is str else str(v)
+
+                yield item
+
+    def _estimate_total(self) -> Optional[int]:
+        # Оценка размера таблицы из sqlite_stat1 (заполняется ANALYZE):
+        # первая цифра stat — приблизительное число строк
+        try:
+            cur = self.conn.cursor()
+            cur.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = ? AND idx IS NULL", (self.table,)
+            )
+            row = cur.fetchone()
+            if row and row[0]:
+                return int(str(row[0]).split()[0])
+        except sqlite3.Error:
+            pass
+        return None
+
+    def count(
+        self,
+        start_after_id: int = 0,
+        limit_rows: Optional[int] = None,
+        filter_topic_id: Optional[int] = None,
+        filter_topic_title_contains: Optional[str] = None,
+        min_text_len: Optional[int] = None,
+        exact: bool = True,
+    ) -> int:
+        """
+        Подсчёт количества сообщений для обработки: id > start_after_id,
+        с учётом фильтров. Если задан limit_rows, возвращается
+        min(реального количества, limit_rows).
+
+        exact=False разрешает приблизительный ответ из sqlite_stat1 (только
+        для безфильтрового подсчёта с начала таблицы — годится для прогресса);
+        без статистики происходит откат к точному COUNT(*).
+        """
+        if (
+            not exact
+            and start_after_id == 0
+            and filter_topic_id is None
+            and not filter_topic_title_contains
+            and min_text_len is None
+        ):
+            est = self._estimate_total()
+            if est is not None:
+                return min(est, int(limit_rows)) if limit_rows is not None else est
+
+        where, params = self._where(
+            start_after_id, filter_topic_id, filter_topic_title_contains, min_text_len
+        )
+        sql = f"SELECT COUNT(*) FROM {self.table} WHERE " + " AND ".join(where)
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        total = int(cur.fetchone()[0] or 0)
+        if limit_rows is not None:
+            total = min(total, int(limit_rows))
+        return total
 
 
 def iter_messages(
@@ -12,88 +342,62 @@ def iter_messages(
     min_text_len: Optional[int] = None,
 ) -> Generator[Dict, None, None]:
     """
-    Универсальный итератор по строкам SQLite.
+    Универсальный итератор по строкам SQLite (тонкая обёртка над MessagesReader).
     Ожидается как минимум схема: (id INTEGER PRIMARY KEY, text TEXT NOT NULL)
 
     Возвращает элементы вида:
       {"id": int, "text": str, "source_id": f"msg:{id}"}
     """
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    try:
-        cur = conn.cursor()
+    with MessagesReader(db_path, table) as reader:
+        yield from reader.iter(
+            start_after_id=start_after_id,
+            limit_rows=limit_rows,
+            filter_topic_id=filter_topic_id,
+            filter_topic_title_contains=filter_topic_title_contains,
+            min_text_len=min_text_len,
+        )
 
-        # Проверим наличие колонок и выберем подходящее текстовое поле (универсально)
-        cur.execute(f"PRAGMA table_info({table})")
-        cols = [r["name"] for r in cur.fetchall()]
-        if "id" not in cols:
-            raise RuntimeError(f"Таблица {table} должна содержать колонку id. Найдены: {cols}")
-
-        # Универсальный выбор текстовой колонки: text | message | content | body
-        text_col = None
-        for cand in ("text", "message", "content", "body"):
-            if cand in cols:
-                text_col = cand
-                break
-        if not text_col:
-            raise RuntimeError(
-                f"Таблица {table} должна содержать одну из текстовых колонок (text|message|content|body). Найдены: {cols}"
-            )
 
-        # Дополнительно детектируем служебные поля если присутствуют
-        date_col = "date" if "date" in cols else None
-        topic_id_col = "topic_id" if "topic_id" in cols else None
-        topic_title_col = "topic_title" if "topic_title" in cols else None
-
-        # Сформируем SELECT с опциональными колонками
-        select_cols = [f"id", f"{text_col} AS text"]
-        if date_col:
-            select_cols.append(f"{date_col} AS date")
-        if topic_id_col:
-            select_cols.append(f"{topic_id_col} AS topic_id")
-        if topic_title_col:
-            select_cols.append(f"{topic_title_col} AS topic_title")
+def iter_messages_with_count(
+    db_path: str,
+    table: str = "messages",
+    start_after_id: int = 0,
+    limit_rows: Optional[int] = None,
+    filter_topic_id: Optional[int] = None,
+    filter_topic_title_contains: Optional[str] = None,
+    min_text_len: Optional[int] = None,
+) -> Tuple[int, Generator[Dict, None, None]]:
+    """
+    То же, что count_messages + iter_messages, но одним запросом: количество
+    берётся из оконного COUNT(*) OVER () в первой строке результата, так что
+    B-tree с одним и тем же предикатом не сканируется дважды.
 
-        # Порядок обхода от старых к новым: ORDER BY id ASC
-        where = ["id > ?"]
-        params = [start_after_id]
-        if min_text_len is not None:
-            where.append(f"length({text_col}) >= ?")
-            params.append(int(min_text_len))
-        if filter_topic_id is not None and topic_id_col:
-            where.append(f"{topic_id_col} = ?")
-            params.append(int(filter_topic_id))
-        if filter_topic_title_contains and topic_title_col:
-            where.append(f"{topic_title_col} LIKE ?")
-            params.append(f"%{filter_topic_title_contains}%")
-        sql = f"SELECT {', '.join(select_cols)} FROM {table} WHERE " + " AND ".join(where) + " ORDER BY id ASC"
-        if limit_rows is not None:
-            sql += " LIMIT ?"
-            params.append(int(limit_rows))
+    Возврат: (total, генератор элементов). total уже ограничен limit_rows.
+    """
+    reader = MessagesReader(db_path, table)
 
-        for row in cur.execute(sql, params):
-            rid = int(row["id"])
-            text = str(row["text"] or "")
-            # Опциональные поля
-            date_val = str(row["date"]) if ("date" in row.keys()) and (row["date"] is not None) else None
-            topic_id_val = int(row["topic_id"]) if ("topic_id" in row.keys()) and (row["topic_id"] is not None) else None
-            topic_title_val = str(row["topic_title"]) if ("topic_title" in row.keys()) and (row["topic_title"] is not None) else None
-
-            item = {
-                "id": rid,
-                "text": text,
-                "source_id": f"msg:{rid}",
-            }
-            if date_val is not None:
-                item["date"] = date_val
-            if topic_id_val is not None:
-                item["topic_id"] = topic_id_val
-            if topic_title_val is not None:
-                item["topic_title"] = topic_title_val
-
-            yield item
-    finally:
-        conn.close()
+    def _gen() -> Generator[Dict, None, None]:
+        try:
+            yield from reader.iter(
+                start_after_id=start_after_id,
+                limit_rows=limit_rows,
+                filter_topic_id=filter_topic_id,
+                filter_topic_title_contains=filter_topic_title_contains,
+                min_text_len=min_text_len,
+                with_total=True,
+            )
+        finally:
+            reader.close()
+
+    gen = _gen()
+    try:
+        total = next(gen)
+    except StopIteration:
+        reader.close()
+        return 0, iter(())
+    if limit_rows is not None:
+        total = min(int(total), int(limit_rows))
+    return int(total), gen
 
 
 def collect_items_from_db(
@@ -120,6 +424,30 @@ def collect_items_from_db(
     )
 
 
+def collect_items_from_db_with_count(
+    db_path: str,
+    table: str = "messages",
+    start_after_id: int = 0,
+    limit_rows: Optional[int] = None,
+    filter_topic_id: Optional[int] = None,
+    filter_topic_title_contains: Optional[str] = None,
+    min_text_len: Optional[int] = None,
+) -> Tuple[int, Iterable[Dict]]:
+    """
+    Вариант collect_items_from_db, дополнительно возвращающий количество
+    элементов (одним сканом, см. iter_messages_with_count).
+    """
+    return iter_messages_with_count(
+        db_path=db_path,
+        table=table,
+        start_after_id=start_after_id,
+        limit_rows=limit_rows,
+        filter_topic_id=filter_topic_id,
+        filter_topic_title_contains=filter_topic_title_contains,
+        min_text_len=min_text_len,
+    )
+
+
 def count_messages(
     db_path: str,
     table: str = "messages",
@@ -128,45 +456,19 @@ def count_messages(
     filter_topic_id: Optional[int] = None,
     filter_topic_title_contains: Optional[str] = None,
     min_text_len: Optional[int] = None,
+    exact: bool = True,
 ) -> int:
     """
     Подсчёт количества сообщений для обработки: id > start_after_id, с учётом фильтров.
     Если задан limit_rows, возвращается min(реального количества, limit_rows).
+    exact=False допускает приблизительный ответ из sqlite_stat1 (см. MessagesReader.count).
     """
-    conn = sqlite3.connect(db_path)
-    try:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
-        # Детектируем колонки, чтобы корректно сформировать условия
-        cur.execute(f"PRAGMA table_info({table})")
-        cols = [r["name"] for r in cur.fetchall()]
-        # Универсальный выбор текстовой колонки
-        text_col = None
-        for cand in ("text", "message", "content", "body"):
-            if cand in cols:
-                text_col = cand
-                break
-        topic_id_col = "topic_id" if "topic_id" in cols else None
-        topic_title_col = "topic_title" if "topic_title" in cols else None
-
-        where = ["id > ?"]
-        params = [start_after_id]
-        if min_text_len is not None and text_col:
-            where.append(f"length({text_col}) >= ?")
-            params.append(int(min_text_len))
-        if filter_topic_id is not None and topic_id_col:
-            where.append(f"{topic_id_col} = ?")
-            params.append(int(filter_topic_id))
-        if filter_topic_title_contains and topic_title_col:
-            where.append(f"{topic_title_col} LIKE ?")
-            params.append(f"%{filter_topic_title_contains}%")
-
-        sql = f"SELECT COUNT(*) FROM {table} WHERE " + " AND ".join(where)
-        cur.execute(sql, params)
-        total = int(cur.fetchone()[0] or 0)
-        if limit_rows is not None:
-            total = min(total, int(limit_rows))
-        return total
-    finally:
-        conn.close()
+    with MessagesReader(db_path, table) as reader:
+        return reader.count(
+            start_after_id=start_after_id,
+            limit_rows=limit_rows,
+            filter_topic_id=filter_topic_id,
+            filter_topic_title_contains=filter_topic_title_contains,
+            min_text_len=min_text_len,
+            exact=exact,
+        )
@@ -1,24 +1,36 @@
-import json
+import concurrent.futures
 import os
+import queue
 import re
+import signal
+import threading
 from dataclasses import dataclass
+from itertools import islice
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 import sys
 import time
 
+# numpy опционален — см. estimate_tokens_batch в utils
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from .utils import (
     ensure_dir,
-    append_jsonl,
+    estimate_tokens_batch,
+    json_dumps_bytes,
     now_ts,
-    token_estimate,
     hash_fact,
     Checkpoint,
     CheckpointManager,
+    load_json,
     save_json_atomic,
+    save_json_atomic_gz,
 )
 from .prompting import build_messages
-from .extract import collect_items_from_db, count_messages
-from .cloudru import CloudRuBackend
+from .extract import collect_items_from_db_with_count, ensure_indexes
+from .cloudru import BatchBackend, CachedBackend, CloudRuBackend
 
 
 @dataclass
@@ -39,7 +51,11 @@ class BuilderConfig:
 
     # Поведение
     hints: str = ""
-    backend: str = "mock"  # 'mock' | 'cloudru'
+    raw_compress: bool = True  # писать raw/*.json.gz вместо raw/*.json
+    save_raw: str = "always"  # 'always' | 'on_accept' | 'never'
+    checkpoint_every: int = 25  # писать checkpoint.json раз в N батчей
+    max_concurrency: int = 8  # число одновременно обрабатываемых батчей
+    backend: str = "mock"  # 'mock' | 'cloudru' | 'cloudru_batch'
     primary_model: str = "openai/gpt-oss-120b"
     fallback_model: Optional[str] = "Qwen/Qwen3-235B-A22B-Instruct-2507"
     dotenv_path: Optional[str] = None
@@ -51,18 +67,22 @@ class MockBackend:
     Из каждого источника пытается извлечь одно короткое утверждение.
     """
 
-    SENT_SPLIT = re.compile(r"[.!?]\s+")
+    SENT_END = re.compile(r"[.!?]\s")
 
     def _first_sentence(self, text: str) -> str:
         text = (text or "").strip()
         if not text:
             return ""
-        parts = self.SENT_SPLIT.split(text)
-        sent = parts[0].strip() if parts else text
-        # ограничим по словам ~60
-        words = sent.split()
-        if len(words) > 60:
-            sent = " ".join(words[:60])
+        # search останавливается на первом [.!?] + пробел — не режем весь
+        # текст на предложения ради первого
+        m = self.SENT_END.search(text)
+        sent = text[: m.start()].strip() if m else text
+        # ограничим по словам ~60; count(" ") — дешёвая верхняя оценка,
+        # полный split только если лимит реально мог быть превышен
+        if sent.count(" ") >= 60:
+            words = sent.split()
+            if len(words) > 60:
+                sent = " ".join(words[:60])
         return sent
 
     def generate(self, sources: List[Dict[str, Any]], gen_max_tokens: int, temperature: float, top_p: float, messages: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
@@ -95,14 +115,27 @@ class KnowledgeBuilder:
         ensure_dir(self.state_dir_abs)
 
         # Бэкенд
+        self.batch_backend: Optional[BatchBackend] = None
         if self.cfg.backend == "mock":
             self.backend = MockBackend()
         elif self.cfg.backend == "cloudru":
+            # Онлайновый бэкенд оборачиваем персистентным кэшем: повторные
+            # прогоны и повторяющиеся короткие сообщения не ходят в сеть
+            self.backend = CachedBackend(
+                CloudRuBackend(
+                    primary_model=self.cfg.primary_model,
+                    fallback_model=self.cfg.fallback_model,
+                    dotenv_path=self.cfg.dotenv_path,
+                ),
+                cache_path=os.path.join(self.state_dir_abs, "cache.sqlite"),
+            )
+        elif self.cfg.backend == "cloudru_batch":
             self.backend = CloudRuBackend(
                 primary_model=self.cfg.primary_model,
                 fallback_model=self.cfg.fallback_model,
                 dotenv_path=self.cfg.dotenv_path,
             )
+            self.batch_backend = BatchBackend(self.backend)
         else:
             self.backend = MockBackend()
 
@@ -112,6 +145,11 @@ class KnowledgeBuilder:
 
         # Файлы артефактов
         self.knowledge_path = os.path.join(self.art_out_dir, "knowledge.jsonl")
+        # Долгоживущий буферизованный writer: открытие файла на каждый батч —
+        # лишний syscall + поиск в каталоге (ленивое открытие в _knowledge_out)
+        self._knowledge_fp = None
+        # Незавершённые batch-джобы (для резюмирования опроса после сбоя)
+        self.pending_batches_path = os.path.join(self.state_dir_abs, "pending_batches.json")
 
         # Статистика
         self.batches = 0
@@ -124,13 +162,52 @@ class KnowledgeBuilder:
         self.processed_count = 0
         self.start_time = None
 
-    def _batch_budget_ok(self, current_tokens: int, next_item_text: str) -> bool:
-        add = self.cfg.per_item_overhead + token_estimate(next_item_text)
-        return (current_tokens + add) <= self.cfg.context_budget
+        # Конкурентная обработка: сетевые вызовы идут параллельно, а приёмка
+        # фактов / чекпоинты / статистика сериализуются этим локом
+        self._post_lock = threading.Lock()
+        # Коммит чекпоинта строго в порядке отправки батчей (см. _commit_batch)
+        self._completed_batches: Dict[int, int] = {}
+        self._next_commit_seq = 0
+        # Группировка записей checkpoint.json (см. _maybe_save_checkpoint)
+        self._batches_since_ckpt = 0
+
+    def _commit_batch(self, seq: int, last_id: int) -> None:
+        """
+        Продвигает чекпоинт строго в порядке отправки батчей: last_id пишется
+        только когда завершились все батчи с меньшими номерами, чтобы crash
+        между несмежными завершениями не «перепрыгнул» необработанные строки.
+        Вызывается под _post_lock.
+        """
+        self._completed_batches[seq] = last_id
+        advanced = False
+        while self._next_commit_seq in self._completed_batches:
+            lid = self._completed_batches.pop(self._next_commit_seq)
+            if self.cp:
+                self.cp.last_id = lid
+                advanced = True
+            self._next_commit_seq += 1
+        if advanced:
+            self._batches_since_ckpt += 1
+            self._maybe_save_checkpoint()
+
+    def _maybe_save_checkpoint(self, force: bool = False) -> None:
+        """
+        Групповой коммит checkpoint.json: last_id пишется раз в
+        cfg.checkpoint_every батчей (или принудительно — на выходе/SIGINT),
+        а не на каждый. Потеря при сбое ограничена повторной обработкой
+        до N батчей, дубликаты при этом отсекает hashes.log.
+        Вызывается под _post_lock.
+        """
+        if self.cp is None:
+            return
+        if force or self._batches_since_ckpt >= max(1, self.cfg.checkpoint_every):
+            self.cp_mgr.save(self.cp)
+            self._batches_since_ckpt = 0
 
     def _finalize_and_run_batch(
         self,
         batch: List[Dict[str, Any]],
+        seq: int = 0,
     ) -> Tuple[int, int]:
         """
         Возвращает (accepted_in_batch, errors_in_batch)
@@ -138,8 +215,15 @@ class KnowledgeBuilder:
         if not batch:
             return (0, 0)
 
-        # Подготовим источники
-        sources = [{"source_id": it["source_id"], "text": it["text"]} for it in batch]
+        # Подготовим источники. Одинаковые тексты (форварды, «ок», подписи
+        # стикеров) схлопываем до одного представителя — модель не тратит
+        # токены на дубликаты, а принятые факты разворачиваются обратно
+        # на все source_id через sid_aliases
+        text_to_ids: Dict[str, List[str]] = {}
+        for it in batch:
+            text_to_ids.setdefault(it["text"], []).append(it["source_id"])
+        sources = [{"source_id": ids[0], "text": txt} for txt, ids in text_to_ids.items()]
+        sid_aliases = {ids[0]: ids for ids in text_to_ids.values() if len(ids) > 1}
 
         # Сформируем prompt (для сохранения в raw)
         messages = build_messages(sources, hints=self.cfg.hints)
@@ -147,6 +231,8 @@ class KnowledgeBuilder:
         # Диапазон текущего батча (для логирования прогресса)
         first_id = batch[0]["id"]
         last_id = batch[-1]["id"]
+        # Одна метка времени на батч: strftime недёшев, а вызывался до 5 раз
+        ts = now_ts()
         self._log(f"[processing] диапазон: {first_id}-{last_id}")
 
         # Вызов модели
@@ -158,23 +244,22 @@ class KnowledgeBuilder:
             top_p=self.cfg.top_p,
         )
 
-        # Сохранение сырого вывода
+        # Сырой вывод буферизуется и пишется одним файлом на батч
+        # (initial + retry в attempts) после приёмки — см. cfg.save_raw
         raw_payload = {
-            "ts": now_ts(),
+            "ts": ts,
             "range": {"first_id": first_id, "last_id": last_id},
-            "messages": messages,
             "model_params": {
                 "gen_max_tokens": self.cfg.gen_max_tokens,
                 "temperature": self.cfg.temperature,
                 "top_p": self.cfg.top_p,
             },
-            "output": model_output,
+            "attempts": [{"messages": messages, "output": model_output}],
         }
-        raw_name = f"{now_ts()}_{first_id}-{last_id}.json"
-        save_json_atomic(os.path.join(self.raw_dir, raw_name), raw_payload)
 
-        # Валидация/приёмка фактов
-        accepted = self._accept_facts(model_output, batch)
+        # Валидация/приёмка фактов (под локом: пишем в общие файлы/чекпоинт)
+        with self._post_lock:
+            accepted = self._accept_facts(model_output, batch, ts=ts, sid_aliases=sid_aliases)
 
         # При пустой приёмке попробуем второй проход с уточняющими подсказками
         if accepted == 0:
@@ -187,53 +272,127 @@ class KnowledgeBuilder:
                 temperature=self.cfg.temperature,
                 top_p=self.cfg.top_p,
             )
-            # сохраним сырой вывод ретрая
-            raw_payload_retry = {
-                "ts": now_ts(),
-                "range": {"first_id": first_id, "last_id": last_id},
-                "messages": messages_retry,
-                "model_params": {
-                    "gen_max_tokens": self.cfg.gen_max_tokens,
-                    "temperature": self.cfg.temperature,
-                    "top_p": self.cfg.top_p,
-                },
-                "output": model_output_retry,
-                "retry": True,
-            }
-            raw_name_retry = f"{now_ts()}_{first_id}-{last_id}_retry.json"
-            save_json_atomic(os.path.join(self.raw_dir, raw_name_retry), raw_payload_retry)
+            raw_payload["attempts"].append(
+                {"messages": messages_retry, "output": model_output_retry, "retry": True}
+            )
 
-            accepted = self._accept_facts(model_output_retry, batch)
+            with self._post_lock:
+                accepted = self._accept_facts(model_output_retry, batch, ts=ts, sid_aliases=sid_aliases)
 
-        # Продвинем чекпоинт
-        if self.cp:
-            self.cp.last_id = last_id
-            self.cp_mgr.save(self.cp)
+        if self.cfg.save_raw == "always" or (self.cfg.save_raw == "on_accept" and accepted > 0):
+            # Наносекундный префикс вместо секундного strftime: быстрые батчи
+            # в одну секунду не перетирают файлы друг друга молча
+            self._save_raw(f"{time.time_ns()}_{first_id}-{last_id}", raw_payload)
 
-        self.batches += 1
-        if accepted == 0:
-            self.empty_batches += 1
-        self.accepted_facts += accepted
+        with self._post_lock:
+            # Продвинем чекпоинт (в порядке отправки батчей)
+            self._commit_batch(seq, last_id)
 
-        # Обновим прогресс
-        self.processed_count += len(batch)
-        self._update_progress(first_id, last_id)
+            self.batches += 1
+            if accepted == 0:
+                self.empty_batches += 1
+            self.accepted_facts += accepted
+
+            # Обновим прогресс
+            self.processed_count += len(batch)
+            self._update_progress(first_id, last_id)
 
         return (accepted, 0)
 
-    def _accept_facts(self, output: Any, batch: List[Dict[str, Any]]) -> int:
+    def _run_batch_api(self, batches: List[List[Dict[str, Any]]]) -> None:
+        """
+        Обработка через провайдерский Batch API: все промпты уходят одним
+        JSONL-файлом, далее — опрос статуса и приёмка результатов по custom_id
+        (= "{first_id}-{last_id}" батча). batch_id сохраняется в
+        pending_batches.json, так что упавший процесс при перезапуске
+        продолжает опрашивать уже отправленный джоб, а не платит за него заново.
+        """
+        if not batches:
+            return
+
+        prompts: List[Dict[str, Any]] = []
+        index: Dict[str, Tuple[int, List[Dict[str, Any]], Dict[str, List[str]]]] = {}
+        for i, b in enumerate(batches):
+            cid = f"{b[0]['id']}-{b[-1]['id']}"
+            # Тот же дедуп одинаковых текстов, что и в _finalize_and_run_batch
+            text_to_ids: Dict[str, List[str]] = {}
+            for it in b:
+                text_to_ids.setdefault(it["text"], []).append(it["source_id"])
+            sources = [{"source_id": ids[0], "text": txt} for txt, ids in text_to_ids.items()]
+            aliases = {ids[0]: ids for ids in text_to_ids.values() if len(ids) > 1}
+            prompts.append({"custom_id": cid, "messages": build_messages(sources, hints=self.cfg.hints)})
+            index[cid] = (i, b, aliases)
+
+        # Резюмирование: если ранее отправленный джоб покрывает те же батчи —
+        # продолжаем опрашивать его
+        pending = load_json(self.pending_batches_path, default=None)
+        batch_id = None
+        if isinstance(pending, dict) and pending.get("custom_ids") == sorted(index):
+            batch_id = pending.get("batch_id")
+        if not batch_id:
+            batch_id = self.batch_backend.submit_batch(
+                prompts, self.cfg.gen_max_tokens, self.cfg.temperature, self.cfg.top_p
+            )
+            save_json_atomic(
+                self.pending_batches_path,
+                {"batch_id": batch_id, "custom_ids": sorted(index)},
+            )
+        self._log(f"[batch-api] джоб {batch_id}: батчей {len(batches)}, ожидание результатов")
+
+        status = self.batch_backend.wait(batch_id)
+        results = self.batch_backend.fetch_results(batch_id) if status == "completed" else {}
+        self._log(f"[batch-api] джоб {batch_id}: статус {status}, результатов {len(results)}")
+
+        ts = now_ts()
+        for cid, (i, b, aliases) in sorted(index.items(), key=lambda kv: kv[1][0]):
+            output = results.get(cid)
+            with self._post_lock:
+                if output is None:
+                    self.errors += 1
+                    accepted = 0
+                else:
+                    accepted = self._accept_facts(output, b, ts=ts, sid_aliases=aliases)
+                self._commit_batch(i, b[-1]["id"])
+                self.batches += 1
+                if accepted == 0:
+                    self.empty_batches += 1
+                self.accepted_facts += accepted
+                self.processed_count += len(b)
+                self._update_progress(b[0]["id"], b[-1]["id"])
+
+        # Джоб обработан — убираем из незавершённых
+        try:
+            os.remove(self.pending_batches_path)
+        except OSError:
+            pass
+
+    def _accept_facts(
+        self,
+        output: Any,
+        batch: List[Dict[str, Any]],
+        ts: Optional[str] = None,
+        sid_aliases: Optional[Dict[str, List[str]]] = None,
+    ) -> int:
+        if ts is None:
+            ts = now_ts()
         if not isinstance(output, dict):
             return 0
         facts = output.get("facts")
         if not isinstance(facts, list):
             return 0
 
-        # Быстрый доступ к текстам по source_id
-        text_by_sid = {it["source_id"]: it["text"] for it in batch}
-        item_by_sid = {it["source_id"]: it for it in batch}
-        known_sids = set(text_by_sid.keys())
+        # Один индекс sid → позиция в батче вместо двух параллельных словарей
+        # (text_by_sid/item_by_sid): одна хэш-таблица на батч, текст и
+        # метаданные достаются индексацией списка
+        index_by_sid = {it["source_id"]: i for i, it in enumerate(batch)}
 
         accepted_items: List[Dict[str, Any]] = []
+        batch_seen: set = set()  # дубликаты внутри одного батча
+        # Горячий цикл: атрибутные lookups и bound-методы поднимаем в локальные
+        # переменные — убирает LOAD_ATTR/LOAD_METHOD на каждый факт
+        cp_seen = self.cp.seen_hashes if self.cp else None
+        batch_seen_add = batch_seen.add
+        accepted_append = accepted_items.append
         for fact in facts:
             if not isinstance(fact, dict):
                 continue
@@ -254,59 +413,67 @@ class KnowledgeBuilder:
                     continue
                 sid = s.get("source_id")
                 quote = s.get("quote")
-                if not isinstance(sid, str) or not re.match(r"^msg:\d+$", sid):
+                # Формат "msg:<id>": пара строковых проверок на уровне C
+                # вместо прогона regex на каждый источник каждого факта
+                if not (isinstance(sid, str) and sid.startswith("msg:") and sid[4:].isdigit()):
                     continue
-                if sid not in known_sids:
+                idx = index_by_sid.get(sid)
+                if idx is None:
                     continue
                 if quote is not None and not isinstance(quote, str):
                     continue
-                # Если цитата есть — проверим, что она встречается в исходном тексте (простая проверка)
-                if isinstance(quote, str) and quote.strip():
-                    if quote.strip() not in text_by_sid[sid]:
-                        # Мягкая проверка: проигнорируем quote, но оставим источник
-                        valid_sources.append({"source_id": sid})
-                        ok = True
-                        continue
-                valid_sources.append({"source_id": sid} if not quote else {"source_id": sid, "quote": quote})
+                # Если цитата есть — проверим, что она встречается в исходном
+                # тексте (мягкая проверка: при несовпадении источник остаётся,
+                # а quote отбрасывается). strip() — один раз; цитаты короче
+                # 4 символов («ок», «да») не несут доказательной ценности,
+                # подстрочный скан для них не запускаем
+                sq = quote.strip() if quote else ""
+                keep_quote = len(sq) >= 4 and sq in batch[idx]["text"]
+                # Представитель дубликатов разворачивается на все свои source_id
+                # (тексты идентичны, так что и цитата валидна для каждого)
+                alias_ids = sid_aliases.get(sid, (sid,)) if sid_aliases else (sid,)
+                for asid in alias_ids:
+                    valid_sources.append(
+                        {"source_id": asid, "quote": quote} if keep_quote else {"source_id": asid}
+                    )
                 ok = True
 
             if not ok or not valid_sources:
                 continue
 
-            # Дедуп по стабильному хэшу
+            # Дедуп по стабильному хэшу (set: O(1) на проверку)
             h = hash_fact(statement, valid_sources, category)
-            if self.cp and h in self.cp.seen_hashes:
+            if h in batch_seen or (cp_seen is not None and h in cp_seen):
                 continue
-
-            # Соберём дополнительные метаданные: список id источников, даты, топики
-            sid_nums = []
-            dates = []
-            topic_ids = []
-            topic_titles = []
+            batch_seen_add(h)
+
+            # Соберём дополнительные метаданные: id источников, даты, топики.
+            # Сразу в set — без промежуточных списков и повторной уникализации
+            sid_nums: set = set()
+            dates: set = set()
+            topic_ids: set = set()
+            topic_titles: set = set()
             for s in valid_sources:
                 sid = s.get("source_id", "")
-                try:
-                    num = int(sid.split(":")[1])
-                    sid_nums.append(num)
-                except Exception:
-                    pass
-                it = item_by_sid.get(sid) or {}
-                if "date" in it and it["date"]:
-                    dates.append(str(it["date"]))
-                if "topic_id" in it and it["topic_id"] is not None:
+                # Префикс "msg:" уже провалидирован выше — срез вместо split
+                sid_nums.add(int(sid[4:]))
+                idx = index_by_sid.get(sid)
+                it = batch[idx] if idx is not None else {}
+                if it.get("date"):
+                    dates.add(str(it["date"]))
+                if it.get("topic_id") is not None:
                     try:
-                        topic_ids.append(int(it["topic_id"]))
-                    except Exception:
+                        topic_ids.add(int(it["topic_id"]))
+                    except (TypeError, ValueError):
                         pass
-                if "topic_title" in it and it["topic_title"]:
-                    topic_titles.append(str(it["topic_title"]))
-            # Уникализация и сортировка
-            sid_nums_uniq = sorted(set(sid_nums))
-            dates_uniq = sorted(set(dates))
-            topic_ids_uniq = sorted(set(topic_ids))
-            topic_titles_uniq = sorted(set(topic_titles))
+                if it.get("topic_title"):
+                    topic_titles.add(str(it["topic_title"]))
+            sid_nums_uniq = sorted(sid_nums)
+            dates_uniq = sorted(dates)
+            topic_ids_uniq = sorted(topic_ids)
+            topic_titles_uniq = sorted(topic_titles)
             meta_obj = {
-                "ts": now_ts(),
+                "ts": ts,
                 "source_ids_csv": ",".join(str(x) for x in sid_nums_uniq) if sid_nums_uniq else "",
             }
             if dates_uniq:
@@ -322,7 +489,7 @@ class KnowledgeBuilder:
             elif topic_titles_uniq:
                 meta_obj["topic_titles"] = topic_titles_uniq
 
-            accepted_items.append(
+            accepted_append(
                 {
                     "statement": statement.strip(),
                     "sources": valid_sources,
@@ -335,19 +502,39 @@ class KnowledgeBuilder:
         if not accepted_items:
             return 0
 
-        # Запишем
-        append_jsonl(self.knowledge_path, accepted_items)
+        # Запишем через постоянный writer (flush один раз на батч)
+        fp = self._knowledge_out()
+        for it in accepted_items:
+            fp.write(json_dumps_bytes(it))
+            fp.write(b"\n")
+        fp.flush()
 
-        # Обновим seen_hashes
+        # Обновим seen_hashes: в память + append-only сайдкар (только новые)
         if self.cp:
-            for it in accepted_items:
-                h = it["hash"]
-                if h not in self.cp.seen_hashes:
-                    self.cp.seen_hashes.append(h)
-            self.cp_mgr.save(self.cp)
+            new_hashes = [it["hash"] for it in accepted_items]
+            self.cp.seen_hashes.update(new_hashes)
+            self.cp_mgr.append_hashes(new_hashes)
 
         return len(accepted_items)
 
+    def _save_raw(self, stem: str, payload: Dict[str, Any]) -> None:
+        if self.cfg.raw_compress:
+            save_json_atomic_gz(os.path.join(self.raw_dir, f"{stem}.json.gz"), payload)
+        else:
+            save_json_atomic(os.path.join(self.raw_dir, f"{stem}.json"), payload, indent=False)
+
+    def _knowledge_out(self):
+        if self._knowledge_fp is None:
+            ensure_dir(os.path.dirname(self.knowledge_path) or ".")
+            self._knowledge_fp = open(self.knowledge_path, "ab", buffering=1 << 20)
+        return self._knowledge_fp
+
+    def close(self) -> None:
+        if self._knowledge_fp is not None:
+            self._knowledge_fp.close()
+            self._knowledge_fp = None
+        self.cp_mgr.close()
+
     def _log(self, msg: str) -> None:
         try:
             sys.stderr.write(str(msg) + "\n")
@@ -386,12 +573,16 @@ class KnowledgeBuilder:
         start_after = self.cp.last_id if (resume and self.cp) else 0
         if not resume and self.cp:
             self.cp.last_id = 0
-            self.cp.seen_hashes = []
+            self.cp.seen_hashes = set()
+            self.cp_mgr.clear_hashes()
             self.cp_mgr.save(self.cp)
             start_after = 0
 
-        # Инициализация прогресса
-        self.total_to_process = count_messages(
+        # Индексы под фильтры (best-effort: база может быть read-only)
+        ensure_indexes(db_path, table)
+
+        # Количество и итератор одним сканом (оконный COUNT(*) OVER ())
+        self.total_to_process, items_iter = collect_items_from_db_with_count(
             db_path=db_path,
             table=table,
             start_after_id=start_after,
@@ -404,40 +595,166 @@ class KnowledgeBuilder:
         self.start_time = time.time()
         self._log(f"[progress] total={self.total_to_process} | start_after={start_after} | limit={limit_rows or '∞'}")
 
-        batch: List[Dict[str, Any]] = []
-        tokens_used = 0
+        # Сброс состояния упорядоченного коммита чекпоинтов
+        self._completed_batches = {}
+        self._next_commit_seq = 0
+        self._batches_since_ckpt = 0
 
-        def flush_batch():
-            nonlocal batch, tokens_used
-            if not batch:
-                return
+        # Ctrl-C: принудительно сбрасываем отложенный чекпоинт перед выходом.
+        # signal.signal доступен только из главного потока — иначе пропускаем
+        def _on_sigint(signum, frame):
+            got = self._post_lock.acquire(blocking=False)
             try:
-                self._finalize_and_run_batch(batch)
-            except Exception:
-                self.errors += 1
+                self._maybe_save_checkpoint(force=True)
             finally:
-                batch = []
-                tokens_used = 0
-
-        for item in collect_items_from_db(
-            db_path=db_path,
-            table=table,
-            start_after_id=start_after,
-            limit_rows=limit_rows,
-            filter_topic_id=filter_topic_id,
-            filter_topic_title_contains=filter_topic_title_contains,
-            min_text_len=min_text_len,
-        ):
-            t = item.get("text", "")
-            add_tokens = self.cfg.per_item_overhead + token_estimate(t)
-            if tokens_used > 0 and (tokens_used + add_tokens) > self.cfg.context_budget:
-                flush_batch()
-            batch.append(item)
-            tokens_used += add_tokens
+                if got:
+                    self._post_lock.release()
+            raise KeyboardInterrupt
+        try:
+            prev_sigint = signal.signal(signal.SIGINT, _on_sigint)
+        except ValueError:
+            prev_sigint = None
+
+        if self.batch_backend is not None:
+            # Режим Batch API: собираем все батчи и отправляем одним джобом
+            all_batches: List[List[Dict[str, Any]]] = []
+            batch_acc: List[Dict[str, Any]] = []
+            acc_tokens = 0
+            for item in items_iter:
+                t = item.get("text", "")
+                # Инлайн token_estimate: ~len/4, без вызова функции в горячем цикле
+                add_tokens = self.cfg.per_item_overhead + ((len(t) >> 2) or 1)
+                item["_est"] = add_tokens
+                if acc_tokens > 0 and (acc_tokens + add_tokens) > self.cfg.context_budget:
+                    all_batches.append(batch_acc)
+                    batch_acc = []
+                    acc_tokens = 0
+                batch_acc.append(item)
+                acc_tokens += add_tokens
+            if batch_acc:
+                all_batches.append(batch_acc)
+            try:
+                self._run_batch_api(all_batches)
+                return self._finish_run()
+            finally:
+                if prev_sigint is not None:
+                    signal.signal(signal.SIGINT, prev_sigint)
+                with self._post_lock:
+                    self._maybe_save_checkpoint(force=True)
+                self.close()
+
+        seq = 0
+        workers = max(1, int(self.cfg.max_concurrency))
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        inflight: set = set()
+        # Чтение из SQLite и сетевые вызовы перекрываются: фоновый продьюсер
+        # нарезает строки на батчи и кладёт их в ограниченную очередь, пока
+        # потребитель скармливает готовые батчи пулу потоков
+        batch_q: "queue.Queue[Optional[List[Dict[str, Any]]]]" = queue.Queue(maxsize=workers * 2)
+
+        def run_batch(b: List[Dict[str, Any]], s: int) -> None:
+            try:
+                self._finalize_and_run_batch(b, s)
+            except Exception:
+                with self._post_lock:
+                    self.errors += 1
+                    # Коммитим место батча, чтобы не заблокировать чекпоинты
+                    self._commit_batch(s, b[-1]["id"])
+
+        def producer() -> None:
+            batch: List[Dict[str, Any]] = []
+            tokens_used = 0
+            budget = self.cfg.context_budget
+
+            def emit() -> None:
+                nonlocal batch, tokens_used
+                if batch:
+                    batch_q.put(batch)  # блокируется при заполненной очереди
+                    batch = []
+                    tokens_used = 0
 
-        # финальный батч
-        flush_batch()
+            try:
+                # Чанками по 4096 строк: оценка токенов — одним векторным проходом,
+                # границы батчей внутри чанка — через cumsum/searchsorted (с numpy)
+                while True:
+                    chunk = list(islice(items_iter, 4096))
+                    if not chunk:
+                        break
+                    ests = estimate_tokens_batch(
+                        [it.get("text") or "" for it in chunk], self.cfg.per_item_overhead
+                    )
+                    if np is not None:
+                        cum = np.cumsum(ests)
+                        n = len(chunk)
+                        start = 0
+                        while start < n:
+                            base = int(cum[start - 1]) if start else 0
+                            end = int(np.searchsorted(cum, base + (budget - tokens_used), side="right"))
+                            if end <= start:
+                                if batch:
+                                    # Следующий элемент не влезает в остаток бюджета
+                                    emit()
+                                    continue
+                                end = start + 1  # одиночный элемент больше бюджета
+                            for j in range(start, end):
+                                chunk[j]["_est"] = int(ests[j])
+                            batch.extend(chunk[start:end])
+                            tokens_used += int(cum[end - 1]) - base
+                            if end < n:
+                                emit()
+                            start = end
+                    else:
+                        for item, add_tokens in zip(chunk, ests):
+                            item["_est"] = add_tokens
+                            if tokens_used > 0 and (tokens_used + add_tokens) > budget:
+                                emit()
+                            batch.append(item)
+                            tokens_used += add_tokens
+
+                # финальный батч
+                emit()
+            except Exception as e:
+                self._log(f"[error] продьюсер БД упал: {e}")
+                with self._post_lock:
+                    self.errors += 1
+            finally:
+                batch_q.put(None)  # сентинел: строк больше не будет
 
+        prod = threading.Thread(target=producer, name="db-producer", daemon=True)
+        prod.start()
+        try:
+            while True:
+                b = batch_q.get()
+                if b is None:
+                    break
+                inflight.add(executor.submit(run_batch, b, seq))
+                seq += 1
+                # Не даём очереди расти бесконечно: ждём освобождения слота
+                if len(inflight) >= workers:
+                    done, _ = concurrent.futures.wait(
+                        inflight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    inflight.difference_update(done)
+        finally:
+            # На аварийном выходе дренируем очередь, чтобы отпустить
+            # заблокированный put() продьюсера; в норме он уже завершился
+            while prod.is_alive():
+                try:
+                    batch_q.get_nowait()
+                except queue.Empty:
+                    pass
+                prod.join(timeout=0.05)
+            concurrent.futures.wait(inflight)
+            executor.shutdown(wait=True)
+            if prev_sigint is not None:
+                signal.signal(signal.SIGINT, prev_sigint)
+            with self._post_lock:
+                self._maybe_save_checkpoint(force=True)
+            self.close()
+
+        return self._finish_run()
+
+    def _finish_run(self) -> Dict[str, Any]:
         # Итоговая статистика
         result = {
             "batches": self.batches,
@@ -20,9 +20,12 @@ def build_arg_parser() -> argparse.ArgumentParser:
     p.add_argument("--state-dir", default=".state", help="Каталог состояния (чекпоинты)")
     p.add_argument("--state-file", default="checkpoint.json", help="Имя файла состояния чекпоинта")
     p.add_argument("--no-resume", action="store_true", help="Игнорировать чекпоинт и начать заново")
+    p.add_argument("--no-raw-compress", action="store_true", help="Писать raw/*.json без gzip-сжатия")
+    p.add_argument("--save-raw", default="always", choices=["always", "on_accept", "never"], help="Когда сохранять сырые дампы промптов/ответов в raw/")
+    p.add_argument("--checkpoint-every", type=int, default=25, help="Писать checkpoint.json раз в N батчей")
 
     # Генерация (для mock/LLM)
-    p.add_argument("--backend", default="mock", choices=["mock", "cloudru"], help="Бэкенд генерации (mock|cloudru)")
+    p.add_argument("--backend", default="mock", choices=["mock", "cloudru", "cloudru_batch"], help="Бэкенд генерации (mock|cloudru|cloudru_batch)")
     p.add_argument("--gen-max-tokens", type=int, default=1024, help="Ограничение токенов вывода")
     p.add_argument("--temperature", type=float, default=0.2, help="Температура выборки")
     p.add_argument("--top-p", type=float, default=0.95, help="Top-p сэмплирование")
@@ -37,6 +40,9 @@ def build_arg_parser() -> argparse.ArgumentParser:
     # Подсказки
     p.add_argument("--hints", default="", help="Дополнительные подсказки (доменно-нейтральные)")
 
+    # Конкурентность
+    p.add_argument("--max-concurrency", type=int, default=8, help="Число одновременно обрабатываемых батчей")
+
     # Фильтры выборки
     p.add_argument("--filter-topic-id", type=int, default=None, help="Обрабатывать только указанный topic_id")
     p.add_argument("--filter-topic-title-contains", default=None, help="Фильтр по подстроке в topic_title (LIKE %%...%%)")
@@ -59,6 +65,10 @@ def main(argv=None) -> int:
         state_dir=args.state_dir,
         state_file=args.state_file,
         hints=(args.hints or "").strip(),
+        raw_compress=not args.no_raw_compress,
+        save_raw=args.save_raw,
+        checkpoint_every=args.checkpoint_every,
+        max_concurrency=args.max_concurrency,
         backend=args.backend,
         primary_model=args.primary_model,
         fallback_model=args.fallback_model,
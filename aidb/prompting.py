@@ -41,6 +41,16 @@ def system_instructions() -> str:
     )
 
 
+BATCH_SCHEMA_EXAMPLE = {
+    "results": [
+        {
+            "row": 1,
+            "facts": FACT_SCHEMA_EXAMPLE["facts"],
+        }
+    ]
+}
+
+
 def _format_sources_block(sources: List[Dict[str, Any]]) -> str:
     # Формируем унифицированный блок источников для user-сообщения
     lines: List[str] = []
@@ -78,6 +88,45 @@ def build_messages(sources: List[Dict[str, Any]], hints: str = "") -> List[Dict[
     ]
 
 
+def build_batched_messages(sources: List[Dict[str, Any]], hints: str = "") -> List[Dict[str, str]]:
+    """
+    Формирует сообщения для пакетной обработки нескольких источников одним вызовом.
+    Каждый источник нумеруется маркером [[N]]; модель должна вернуть JSON вида
+    {"results": [{"row": N, "facts": [...]}, ...]} — по объекту на строку.
+    """
+    sys = system_instructions()
+    sys += (
+        "\n\nПакетный режим: источники пронумерованы маркерами [[N]]. "
+        "Верни JSON-объект строго по схеме "
+        "{\"results\": [{\"row\": N, \"facts\": [...]}]} — отдельный элемент results "
+        "на каждую строку входа (row — номер из маркера [[N]]). "
+        "Если для строки фактов нет, укажи для неё \"facts\": [].\n"
+        f"Схема/пример структуры:\n{BATCH_SCHEMA_EXAMPLE}"
+    )
+    if hints:
+        sys += "\n\nДополнительные подсказки (доменно-нейтральные):\n" + hints.strip()
+
+    lines: List[str] = []
+    for idx, item in enumerate(sources, start=1):
+        sid = item.get("source_id", "")
+        text = item.get("text", "")
+        lines.append(f"[[{idx}]] ({sid})")
+        lines.append(text)
+        lines.append("")
+    user_content = (
+        "Ниже приведены пронумерованные источники. Извлеки факты из каждого, "
+        "соблюдая правила, и верни КОРРЕКТНЫЙ JSON со списком results по номерам строк."
+        "\n\n"
+        + "\n".join(lines).strip()
+        + "\n\nВерни только JSON-объект без пояснений."
+    )
+
+    return [
+        {"role": "system", "content": sys},
+        {"role": "user", "content": user_content},
+    ]
+
+
 def build_repair_messages(bad_output: str) -> List[Dict[str, str]]:
     """
     Сообщения для «ремонта» ответа: преобразовать произвольный/некорректный вывод в валидный JSON заданной схемы.
@@ -1,20 +1,59 @@
+import gzip
 import json
 import os
 import time
 import hashlib
-from dataclasses import dataclass, asdict
-from typing import Any, Dict, Iterable, List, Optional
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+# orjson (C-реализация) заметно быстрее stdlib на длинных строках;
+# опционален — при отсутствии работаем через json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# numpy опционален: векторизует оценку токенов на мультимиллионных корпусах
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
 
-def save_json_atomic(path: str, data: Any) -> None:
+def json_dumps_bytes(obj: Any) -> bytes:
+    # Компактная сериализация в bytes для JSONL-строк
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def save_json_atomic(path: str, data: Any, indent: bool = True) -> None:
+    # indent=False для больших машиночитаемых файлов (raw-дампы):
+    # отступы почти удваивают объём записи
+    ensure_dir(os.path.dirname(path) or ".")
+    tmp_path = f"{path}.tmp"
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data, option=opt))
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2 if indent else None,
+                      separators=None if indent else (",", ":"))
+    os.replace(tmp_path, path)
+
+
+def save_json_atomic_gz(path: str, data: Any, level: int = 1) -> None:
+    # Быстрый gzip (level=1): JSON с повторяющимися промптами сжимается
+    # в 5-10 раз при почти нулевой цене CPU; чтение — zcat/gzip.open
     ensure_dir(os.path.dirname(path) or ".")
     tmp_path = f"{path}.tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with gzip.open(tmp_path, "wb", compresslevel=level) as f:
+        f.write(json_dumps_bytes(data))
     os.replace(tmp_path, path)
 
 
@@ -27,10 +66,10 @@ def load_json(path: str, default: Any = None) -> Any:
 
 def append_jsonl(path: str, items: Iterable[Dict[str, Any]]) -> None:
     ensure_dir(os.path.dirname(path) or ".")
-    with open(path, "a", encoding="utf-8") as f:
+    with open(path, "ab") as f:
         for item in items:
-            f.write(json.dumps(item, ensure_ascii=False))
-            f.write("\n")
+            f.write(json_dumps_bytes(item))
+            f.write(b"\n")
 
 
 def now_ts() -> str:
@@ -44,42 +83,104 @@ def token_estimate(text: str) -> int:
     return max(1, len(text) // 4)
 
 
+def estimate_tokens_batch(texts: List[str], per_item_overhead: int = 0):
+    """
+    Оценка токенов для списка текстов одним проходом (та же формула
+    ~len/4, что и в token_estimate, плюс оверхед на элемент).
+    С numpy возвращает int64-массив (и позволяет искать границы батчей
+    через cumsum/searchsorted), без него — обычный список int.
+    """
+    if np is not None:
+        lens = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+        return (lens >> 2).clip(min=1) + per_item_overhead
+    return [((len(t) >> 2) or 1) + per_item_overhead for t in texts]
+
+
 def hash_fact(statement: str, sources: List[Dict[str, str]], category: Optional[str] = None) -> str:
+    # Хэш нужен только для дедупа, не для криптографии: BLAKE2b заметно
+    # быстрее SHA-256, а 128 бит (32 hex-символа) хватает с запасом и
+    # вдвое сокращает память seen_hashes и размер hashes.log.
+    # Старые 64-символьные SHA-256 хэши в загруженном состоянии остаются
+    # валидными записями set — сравнение идёт по строке целиком.
     src_ids = ",".join(sorted(s.get("source_id", "") for s in sources))
     basis = f"{statement.strip()}|{category or ''}|{src_ids}"
-    return hashlib.sha256(basis.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(basis.encode("utf-8"), digest_size=16).hexdigest()
 
 
 @dataclass
 class Checkpoint:
     last_id: int = 0
-    seen_hashes: List[str] = None
+    # В памяти — set: членство проверяется на каждый факт, список делал
+    # проверку O(n) и приёмку квадратичной на больших корпусах
+    seen_hashes: Optional[Set[str]] = None
 
     def to_dict(self) -> Dict[str, Any]:
-        d = asdict(self)
-        if d["seen_hashes"] is None:
-            d["seen_hashes"] = []
-        return d
+        return {
+            "last_id": self.last_id,
+            # Сериализуем отсортированным списком — стабильный JSON
+            "seen_hashes": sorted(self.seen_hashes) if self.seen_hashes else [],
+        }
 
     @staticmethod
     def from_dict(d: Dict[str, Any]) -> "Checkpoint":
         return Checkpoint(
             last_id=int(d.get("last_id", 0)),
-            seen_hashes=list(d.get("seen_hashes", [])),
+            seen_hashes=set(d.get("seen_hashes", [])),
         )
 
 
 class CheckpointManager:
+    """
+    Состояние разнесено на два файла:
+      - checkpoint.json — крошечный (только last_id), перезаписывается атомарно;
+      - hashes.log — append-only сайдкар, по одному hex-хэшу на строку.
+    Раньше весь список seen_hashes переписывался целиком на каждый батч —
+    O(total_facts) байт на запись; теперь пишутся только новые хэши.
+    """
+
     def __init__(self, state_dir: str, state_file: str = "checkpoint.json") -> None:
         self.state_dir = state_dir
         self.state_path = os.path.join(state_dir, state_file)
+        self.hashes_path = os.path.join(state_dir, "hashes.log")
+        self._hashes_fp = None
         ensure_dir(state_dir)
 
     def load(self) -> Checkpoint:
         data = load_json(self.state_path, default=None)
         if data is None:
-            return Checkpoint(last_id=0, seen_hashes=[])
-        return Checkpoint.from_dict(data)
+            cp = Checkpoint(last_id=0, seen_hashes=set())
+        else:
+            # Легаси-формат мог хранить seen_hashes прямо в checkpoint.json —
+            # from_dict подберёт их, новые дописываются только в сайдкар
+            cp = Checkpoint.from_dict(data)
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    h = line.strip()
+                    if h:
+                        cp.seen_hashes.add(h)
+        return cp
 
     def save(self, cp: Checkpoint) -> None:
-        save_json_atomic(self.state_path, cp.to_dict())
+        # Только last_id: хэши живут в append-only сайдкаре
+        save_json_atomic(self.state_path, {"last_id": cp.last_id})
+
+    def append_hashes(self, new: Iterable[str]) -> None:
+        if self._hashes_fp is None:
+            self._hashes_fp = open(self.hashes_path, "a", encoding="utf-8")
+        for h in new:
+            self._hashes_fp.write(h + "\n")
+        self._hashes_fp.flush()
+
+    def clear_hashes(self) -> None:
+        # Сброс при запуске без resume
+        if self._hashes_fp is not None:
+            self._hashes_fp.close()
+            self._hashes_fp = None
+        with open(self.hashes_path, "w", encoding="utf-8"):
+            pass
+
+    def close(self) -> None:
+        if self._hashes_fp is not None:
+            self._hashes_fp.close()
+            self._hashes_fp = None